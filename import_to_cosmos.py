@@ -1,104 +1,441 @@
-import csv
+import argparse
+import asyncio
 import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import struct
+import sys
 import time
 import logging
-from pymongo import MongoClient, InsertOne
+from logging.handlers import QueueHandler, QueueListener
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from bson import encode, json_util
+from bson.raw_bson import RawBSONDocument
+from pymongo import AsyncMongoClient
 from pymongo.errors import BulkWriteError, ConnectionFailure
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
+LOG_FORMAT = '%(asctime)s - %(processName)s - %(levelname)s - %(message)s'
 CONNECTION_STRING = "CONNECTION_STRING"
 DATABASE_NAME = "dxlrewardsdb"
 COLLECTION_NAME = "msisdn_records"
 CSV_FILE = "SAMPLE_MSISDN_slim.csv"
 BATCH_SIZE = 10000
+CALIBRATION_FILE = "batch_size.json"
+CALIBRATION_COLLECTION = COLLECTION_NAME + "_calibration"
+CALIBRATION_ROWS = 50000
+CALIBRATION_SIZES = (500, 1000, 2000, 5000, 10000)
+MAX_BATCH_BYTES = 16_000_000
+BATCH_SAFETY_MARGIN = 1000
+MAX_MSISDN_LENGTH = 15
+CSV_BLOCK_SIZE = 8 << 20
 LOG_FREQUENCY = 10
 MAX_RETRIES = 3
 RETRY_DELAY = 5
+MAX_CONCURRENCY = 8
+MAX_POOL_SIZE = 64
+SERVER_SELECTION_TIMEOUT_MS = 5000
+ZSTD_MODULES = ("compression.zstd", "backports.zstd", "zstandard")
+NUM_WORKERS = min(4, os.cpu_count() or 1)
+ID_INDEX = {"key": {"_id": 1}, "name": "_id_"}
+INDEX_BACKUP_FILE = COLLECTION_NAME + "_indexes.json"
+INT32 = struct.Struct("<i")
+ID_ELEMENT = b"\x02_id\x00"
+DOC_TEMPLATE = {
+    "requestId": "batch-import-old-app",
+    "simNumber": "N/A",
+    "simType": "N/A",
+    "status": "completed"
+}
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def configure_logging(log_queue):
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+
+def start_log_listener():
+    log_queue = multiprocessing.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    configure_logging(log_queue)
+    return log_queue, listener
+
+def split_csv(path, parts):
+    size = os.path.getsize(path)
+    ranges = []
+    
+    with open(path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        
+        for i in range(1, parts + 1):
+            if i == parts:
+                end = size
+            else:
+                f.seek(max(start, size * i // parts))
+                f.readline()
+                end = f.tell()
+                
+            if end > start:
+                ranges.append((start, end))
+                start = end
+                
+    return ranges
 
-def process_csv_to_cosmos():
+def read_batches(start, end, batch_size):
+    seen = set()
+    batch = []
+    skipped = 0
+    
+    with pa.memory_map(CSV_FILE) as source:
+        reader = pv.open_csv(
+            source.get_stream(start, end - start),
+            read_options=pv.ReadOptions(column_names=["msisdn"], block_size=CSV_BLOCK_SIZE),
+            convert_options=pv.ConvertOptions(column_types={"msisdn": pa.string()})
+        )
+        
+        for record_batch in reader:
+            msisdns = pc.utf8_trim(record_batch.column(0), characters='"')
+            msisdns = msisdns.filter(pc.greater(pc.utf8_length(msisdns), 0))
+            
+            for msisdn in msisdns.to_pylist():
+                if msisdn in seen:
+                    skipped += 1
+                    continue
+                seen.add(msisdn)
+                batch.append(msisdn)
+                
+                if len(batch) >= batch_size:
+                    yield batch, skipped
+                    batch = []
+                    skipped = 0
+                    
+    if batch or skipped:
+        yield batch, skipped
+
+def encode_doc_tail(import_time):
+    doc = {"allocationDate": import_time, "createdDate": import_time, **DOC_TEMPLATE}
+    return encode(doc)[INT32.size:]
+
+def encode_document(msisdn, doc_tail):
+    value = msisdn.encode()
+    size = INT32.size * 2 + len(ID_ELEMENT) + len(value) + 1 + len(doc_tail)
+    return INT32.pack(size) + ID_ELEMENT + INT32.pack(len(value) + 1) + value + b"\x00" + doc_tail
+
+def encode_documents(msisdns, doc_tail):
+    return [RawBSONDocument(encode_document(msisdn, doc_tail)) for msisdn in msisdns]
+
+async def find_existing_ids(collection, msisdns):
+    if not msisdns:
+        return set()
+    cursor = collection.find({"_id": {"$in": msisdns}}, {"_id": 1})
+    return {doc["_id"] async for doc in cursor}
+
+def module_available(name):
+    try:
+        importlib.import_module(name)
+        return True
+    except ImportError:
+        return False
+
+def available_compressors():
+    compressors = []
+    if any(module_available(name) for name in ZSTD_MODULES):
+        compressors.append("zstd")
+    if module_available("snappy"):
+        compressors.append("snappy")
+    compressors.append("zlib")
+    return compressors
+
+def create_client():
+    return AsyncMongoClient(CONNECTION_STRING, maxPoolSize=MAX_POOL_SIZE, compressors=available_compressors(), serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS)
+
+async def import_csv_range(start, end, import_time, batch_size, concurrency):
     client = None
     total_processed = 0
     total_duplicates = 0
     start_time = time.time()
     batch_count = 0
+    failed = False
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    loop = asyncio.get_running_loop()
+    
+    doc_tail = encode_doc_tail(import_time)
+    
+    async def upload(batch, skipped, raise_errors=False):
+        nonlocal total_processed, total_duplicates, batch_count, failed
+        success, duplicates = await write_batch_with_retry(collection, batch, doc_tail, MAX_RETRIES, raise_errors)
+        total_duplicates += duplicates + skipped
+        if not success:
+            failed = True
+        else:
+            total_processed += len(batch) - duplicates
+            batch_count += 1
+            
+            if batch_count % LOG_FREQUENCY == 0:
+                elapsed = time.time() - start_time
+                rate = total_processed / elapsed if elapsed > 0 else 0
+                logging.info(f"Progress: {total_processed:,} records processed, {total_duplicates:,} duplicates skipped ({rate:.2f} records/s)")
+    
+    def produce(batches):
+        for item in batches:
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+    
+    async def consume():
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            await upload(*item)
     
     try:
-        client = MongoClient(CONNECTION_STRING)
-        db = client[DATABASE_NAME]
-        collection = db[COLLECTION_NAME]
+        client = create_client()
+        collection = client[DATABASE_NAME][COLLECTION_NAME]
+        
+        batches = read_batches(start, end, batch_size)
+        first = await asyncio.to_thread(next, batches, None)
+        if first is None:
+            return total_processed, total_duplicates, failed
+        await upload(*first, raise_errors=True)
         
-        db.command('ping')
-        logging.info("Connected to Cosmos DB successfully")
+        writers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+        
+        try:
+            await asyncio.to_thread(produce, batches)
+        finally:
+            for _ in writers:
+                await queue.put(None)
+            await asyncio.gather(*writers)
         
-        batch = []
+    except ConnectionFailure as e:
+        logging.error(f"Failed to connect to Cosmos DB: {e}")
+        failed = True
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        failed = True
+    finally:
+        if client:
+            await client.close()
+            logging.info("Connection closed")
+    
+    return total_processed, total_duplicates, failed
+
+def import_range(start, end, import_time, batch_size, concurrency):
+    return asyncio.run(import_csv_range(start, end, import_time, batch_size, concurrency))
+
+def max_batch_docs():
+    doc = encode_document("0" * MAX_MSISDN_LENGTH, encode_doc_tail(datetime.datetime.utcnow()))
+    return MAX_BATCH_BYTES // len(doc) - BATCH_SAFETY_MARGIN
+
+async def calibrate_batch_size(import_time, concurrency):
+    ranges = split_csv(CSV_FILE, 1)
+    if not ranges:
+        return None
         
-        with open(CSV_FILE, 'r') as f:
-            csv_reader = csv.reader(f)
-            next(csv_reader)
+    start, end = ranges[0]
+    sample, _ = next(read_batches(start, end, CALIBRATION_ROWS), ([], 0))
+    if len(sample) < CALIBRATION_ROWS:
+        logging.info(f"Only {len(sample):,} rows available, skipping calibration")
+        return None
+        
+    client = create_client()
+    db = client[DATABASE_NAME]
+    collection = db[CALIBRATION_COLLECTION]
+    doc_tail = encode_doc_tail(import_time)
+    semaphore = asyncio.Semaphore(concurrency)
+    best_size, best_rate = None, 0
+    failed = False
+    warmed_up = False
+    
+    async def timed_write(rows):
+        nonlocal failed
+        async with semaphore:
+            if failed:
+                return
+            try:
+                success, _ = await write_batch_with_retry(collection, rows, doc_tail, 1, True)
+            except Exception as e:
+                logging.warning(f"Calibration write failed: {e}")
+                success = False
+            if not success:
+                failed = True
+    
+    try:
+        await db.drop_collection(CALIBRATION_COLLECTION)
+        await asyncio.gather(*(db.command('ping') for _ in range(concurrency)))
+        warmed_up = True
+        
+        for size in CALIBRATION_SIZES:
+            started = time.time()
+            await asyncio.gather(*(timed_write(sample[offset:offset + size]) for offset in range(0, len(sample), size)))
+            elapsed = time.time() - started
             
-            for i, line in enumerate(csv_reader):
-                if not line:
-                    continue
-                    
-                msisdn = line[0].strip('"')
-                current_time = datetime.datetime.utcnow()
-                
-                doc = {
-                    "_id": msisdn,
-                    "allocationDate": current_time,
-                    "createdDate": current_time,
-                    "requestId": "batch-import-old-app",
-                    "simNumber": "N/A",
-                    "simType": "N/A",
-                    "status": "completed"
-                }
+            if failed:
+                logging.warning(f"Calibration write failed at batch size {size:,}, not saving a calibrated batch size")
+                return None
                 
-                batch.append(InsertOne(doc))
+            rate = len(sample) / elapsed if elapsed > 0 else 0
+            logging.info(f"Calibration: batch size {size:,} wrote {rate:.2f} records/s")
+            
+            if rate > best_rate:
+                best_size, best_rate = size, rate
                 
-                if len(batch) >= BATCH_SIZE:
-                    success, duplicates = write_batch_with_retry(collection, batch, MAX_RETRIES)
-                    total_duplicates += duplicates
-                    if success:
-                        total_processed += len(batch) - duplicates
-                        batch_count += 1
-                        
-                        if batch_count % LOG_FREQUENCY == 0:
-                            elapsed = time.time() - start_time
-                            rate = total_processed / elapsed if elapsed > 0 else 0
-                            logging.info(f"Progress: {total_processed:,} records processed, {total_duplicates:,} duplicates skipped ({rate:.2f} records/s)")
-                    batch = []
-                    
-            if batch:
-                success, duplicates = write_batch_with_retry(collection, batch, MAX_RETRIES)
-                total_duplicates += duplicates
-                if success:
-                    total_processed += len(batch) - duplicates
+            await db.drop_collection(CALIBRATION_COLLECTION)
+    finally:
+        if warmed_up:
+            try:
+                await db.drop_collection(CALIBRATION_COLLECTION)
+            except Exception as e:
+                logging.warning(f"Could not drop {CALIBRATION_COLLECTION}: {e}")
+        await client.close()
+        
+    return best_size
+
+def resolve_batch_size(batch_size, recalibrate, import_time, concurrency):
+    if batch_size is not None and batch_size < 1:
+        raise ValueError(f"batch size must be at least 1, got {batch_size}")
+        
+    if batch_size is None and not recalibrate and os.path.exists(CALIBRATION_FILE):
+        with open(CALIBRATION_FILE, 'r') as f:
+            batch_size = json.load(f)["batch_size"]
+        logging.info(f"Using calibrated batch size {batch_size:,} from {CALIBRATION_FILE}")
+        
+    if batch_size is None:
+        batch_size = asyncio.run(calibrate_batch_size(import_time, concurrency))
+        if batch_size is None:
+            batch_size = BATCH_SIZE
+        else:
+            with open(CALIBRATION_FILE, 'w') as f:
+                json.dump({"batch_size": batch_size}, f)
+            logging.info(f"Calibrated batch size {batch_size:,}, saved to {CALIBRATION_FILE}")
+        
+    limit = max_batch_docs()
+    if batch_size > limit:
+        logging.warning(f"Batch size {batch_size:,} exceeds the 16 MB request limit, capping at {limit:,}")
+        batch_size = limit
+        
+    return batch_size
+
+async def update_collection_indexes(indexes):
+    client = create_client()
+    try:
+        await client[DATABASE_NAME].command({"customAction": "UpdateCollection", "collection": COLLECTION_NAME, "indexes": indexes})
+    finally:
+        await client.close()
+
+async def drop_secondary_indexes():
+    if os.path.exists(INDEX_BACKUP_FILE):
+        with open(INDEX_BACKUP_FILE, 'r') as f:
+            indexes = json_util.loads(f.read())
+        logging.warning(f"Found {INDEX_BACKUP_FILE} from an earlier run, its {len(indexes)} indexes will be restored after the import")
+    else:
+        client = create_client()
+        try:
+            cursor = await client[DATABASE_NAME][COLLECTION_NAME].list_indexes()
+            indexes = [{k: v for k, v in index.items() if k not in ("v", "ns")} async for index in cursor]
+        finally:
+            await client.close()
+            
+        if len(indexes) <= 1:
+            return None
+            
+        specs = json_util.dumps(indexes)
+        with open(INDEX_BACKUP_FILE, 'w') as f:
+            f.write(specs)
+        logging.info(f"Saved index specs to {INDEX_BACKUP_FILE}: {specs}")
+        
+    await update_collection_indexes([ID_INDEX])
+    logging.info(f"Dropped {len(indexes) - 1} secondary indexes for the import")
+    return indexes
+
+def restore_indexes(indexes):
+    try:
+        asyncio.run(update_collection_indexes(indexes))
+    except Exception as e:
+        logging.error(f"Failed to restore indexes, specs are kept in {INDEX_BACKUP_FILE}: {e}")
+        return False
+        
+    os.remove(INDEX_BACKUP_FILE)
+    logging.info(f"Restored {len(indexes)} indexes")
+    return True
+
+def process_csv_to_cosmos(batch_size=None, recalibrate=False, drop_indexes=False, workers=NUM_WORKERS, concurrency=MAX_CONCURRENCY):
+    start_time = time.time()
+    import_time = datetime.datetime.utcnow()
+    original_indexes = None
+    succeeded = False
+    log_queue, listener = start_log_listener()
+    
+    try:
+        if drop_indexes:
+            original_indexes = asyncio.run(drop_secondary_indexes())
+            
+        writer_tasks = max(1, concurrency // workers)
+        if workers > concurrency:
+            logging.warning(f"{workers} workers exceed the concurrency limit of {concurrency}, running one insert per worker")
+        logging.info(f"Running {workers} workers with {writer_tasks} inserts in flight each")
+        
+        batch_size = resolve_batch_size(batch_size, recalibrate, import_time, workers * writer_tasks)
+        ranges = split_csv(CSV_FILE, workers)
         
+        with multiprocessing.Pool(processes=len(ranges) or 1, initializer=configure_logging, initargs=(log_queue,)) as pool:
+            results = pool.starmap(import_range, [(start, end, import_time, batch_size, writer_tasks) for start, end in ranges])
+        
+        total_processed = sum(processed for processed, _, _ in results)
+        total_duplicates = sum(duplicates for _, duplicates, _ in results)
+        failed_shards = sum(1 for _, _, failed in results if failed)
         elapsed_time = time.time() - start_time
         records_per_second = total_processed / elapsed_time if elapsed_time > 0 else 0
-        logging.info(f"Import completed. {total_processed:,} records inserted, {total_duplicates:,} duplicates skipped in {elapsed_time:.2f}s ({records_per_second:.2f} records/s)")
+        summary = f"{total_processed:,} records inserted, {total_duplicates:,} duplicates skipped in {elapsed_time:.2f}s ({records_per_second:.2f} records/s)"
         
+        if failed_shards:
+            logging.error(f"Import failed in {failed_shards} of {len(ranges)} shards. {summary}")
+        else:
+            logging.info(f"Import completed. {summary}")
+            succeeded = True
+            
     except ConnectionFailure as e:
         logging.error(f"Failed to connect to Cosmos DB: {e}")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
     finally:
-        if client:
-            client.close()
-            logging.info("Connection closed")
+        if original_indexes and not restore_indexes(original_indexes):
+            succeeded = False
+        listener.stop()
+        
+    return succeeded
 
-def write_batch_with_retry(collection, batch, max_retries):
+async def write_batch_with_retry(collection, batch, doc_tail, max_retries, raise_errors=False):
     duplicate_count = 0
+    docs = None
     
     for attempt in range(max_retries):
         try:
-            result = collection.bulk_write(batch, ordered=False)
+            if docs is None:
+                existing = await find_existing_ids(collection, batch)
+                docs = encode_documents([msisdn for msisdn in batch if msisdn not in existing], doc_tail)
+                duplicate_count += len(existing)
+            if not docs:
+                return True, duplicate_count
+            await collection.insert_many(docs, ordered=False, bypass_document_validation=True)
             return True, duplicate_count
         except BulkWriteError as bwe:
             write_errors = bwe.details.get('writeErrors', [])
+            if not write_errors:
+                return True, duplicate_count
             
-            new_duplicates = sum(1 for err in write_errors if err.get('code') == 11000)
+            new_duplicates = len([err for err in write_errors if err.get('code') == 11000])
             duplicate_count += new_duplicates
             other_errors = len(write_errors) - new_duplicates
             
@@ -114,15 +451,26 @@ def write_batch_with_retry(collection, batch, max_retries):
             if attempt == max_retries - 1:
                 return False, duplicate_count
                 
-            time.sleep(RETRY_DELAY)
+            await asyncio.sleep(RETRY_DELAY)
             
         except Exception as e:
+            if raise_errors:
+                raise
             logging.error(f"Error on attempt {attempt+1}/{max_retries}: {e}")
             if attempt == max_retries - 1:
                 return False, duplicate_count
-            time.sleep(RETRY_DELAY * (attempt + 1))
+            await asyncio.sleep(RETRY_DELAY * (attempt + 1))
             
     return False, duplicate_count
 
 if __name__ == "__main__":
-    process_csv_to_cosmos() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Import MSISDN records from CSV into Cosmos DB")
+    parser.add_argument("--workers", type=positive_int, default=NUM_WORKERS, help=f"worker processes, each importing one slice of the CSV (default {NUM_WORKERS})")
+    parser.add_argument("--concurrency", type=positive_int, default=MAX_CONCURRENCY, help=f"total inserts in flight, split across the workers (default {MAX_CONCURRENCY})")
+    parser.add_argument("--batch-size", type=positive_int, help="documents per insert_many; calibrated on first run when omitted")
+    parser.add_argument("--recalibrate", action="store_true", help=f"ignore {CALIBRATION_FILE} and calibrate again")
+    parser.add_argument("--drop-indexes", action="store_true", help=f"drop secondary indexes during the import and restore them afterwards, specs are saved to {INDEX_BACKUP_FILE}")
+    args = parser.parse_args()
+    
+    if not process_csv_to_cosmos(args.batch_size, args.recalibrate, args.drop_indexes, args.workers, args.concurrency):
+        sys.exit(1) 
\ No newline at end of file